@@ -10,33 +10,261 @@ Key differences from the main implementation:
 - Expects a complete chart.js configuration object directly from the agent
 - Performs only minimal validation on the input configuration
 - Has a more straightforward API that accepts the raw chart configuration directly
-- Uses a simpler approach to URL generation without the QuickChart library dependency
 
 This version is ideal when you need a more lightweight implementation or when you want
 the agent to have more direct control over the chart configuration details.
 """
-import os
+import gzip
+import hashlib
 import json
-from datetime import datetime
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
-from typing import Dict, Optional, Any
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Any, Tuple
+from urllib.parse import quote
 
 import asyncio
 import httpx
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder
+    orjson = None
+
+def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serialize to compact JSON bytes, using orjson when it is available.
+    
+    orjson rejects integers beyond 64 bits, so those configs are re-encoded with the
+    stdlib encoder. orjson writes NaN and Infinity as null, which Chart.js treats as
+    a missing point, just like NaN. Values neither encoder can handle raise ValueError.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+        except orjson.JSONEncodeError:
+            pass
+    try:
+        return json.dumps(
+            obj, separators=(",", ":"), ensure_ascii=False, sort_keys=sort_keys
+        ).encode()
+    except TypeError as e:
+        raise ValueError(f"Chart configuration is not JSON serializable: {e}") from e
+
 load_dotenv()
 
 QUICKCHART_BASE_URL = os.environ.get("QUICKCHART_BASE_URL", "https://quickchart.io/chart")
 
+# Directory of this script, used as the default location for downloaded charts
+_SCRIPT_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+
+# Chunk size used when streaming chart images to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# URLs longer than this are replaced by a QuickChart short URL
+MAX_URL_LENGTH = 4096
+
+# Request bodies larger than this are gzip-compressed
+GZIP_MIN_SIZE = 1024
+
+# Caches for repeated requests with identical chart configurations
+URL_CACHE_SIZE = 256
+PNG_CACHE_SIZE = 32
+PNG_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_URL_CACHE: "OrderedDict[bytes, str]" = OrderedDict()
+_PNG_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_png_cache_bytes = 0
+
+# Upper bound on concurrent render requests sent to QuickChart
+MAX_CONCURRENT_REQUESTS = 8
+
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+_CHART_SEM = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+            http2=True,
+        )
+    return _HTTP_CLIENT
+
+async def _close_client() -> None:
+    """Close the shared HTTP client, if one was created."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
 # Create the MCP server
 mcp = FastMCP("quickchart-server-minimal")
 
-async def generate_chart_url(config: Dict[str, Any]) -> str:
+def _config_key(config: Dict[str, Any]) -> bytes:
+    """Return a stable hash of a chart configuration for cache lookups.
+    
+    Keys are sorted only for hashing. Requests keep the original key order, since
+    Chart.js draws object-form data and scales in insertion order.
+    """
+    return hashlib.blake2b(_dumps(config, sort_keys=True), digest_size=16).digest()
+
+def _cache_get(cache: OrderedDict, key: bytes) -> Any:
+    """Look up a cache entry, marking it as most recently used."""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _cache_put(cache: OrderedDict, key: bytes, value: Any, max_entries: int) -> None:
+    """Store a cache entry, evicting the least recently used entries over the limit."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+
+def _png_cache_put(key: bytes, image: bytes) -> None:
+    """Store a rendered PNG, evicting the least recently used images over the count and byte limits."""
+    global _png_cache_bytes
+    if len(image) > PNG_CACHE_MAX_BYTES:
+        return
+    old = _PNG_CACHE.pop(key, None)
+    if old is not None:
+        _png_cache_bytes -= len(old)
+    _PNG_CACHE[key] = image
+    _png_cache_bytes += len(image)
+    while len(_PNG_CACHE) > PNG_CACHE_SIZE or _png_cache_bytes > PNG_CACHE_MAX_BYTES:
+        _, evicted = _PNG_CACHE.popitem(last=False)
+        _png_cache_bytes -= len(evicted)
+
+def _build_chart_url(encoded_config: bytes) -> str:
+    """Build a URL for the chart from its serialized configuration."""
+    return f"{QUICKCHART_BASE_URL}?c={quote(encoded_config, safe='')}"
+
+def generate_chart_url(config: Dict[str, Any]) -> str:
     """Generate a URL for the chart based on the configuration."""
-    encoded_config = json.dumps(config)
-    return f"{QUICKCHART_BASE_URL}?c={encoded_config}"
+    key = _config_key(config)
+    url = _cache_get(_URL_CACHE, key)
+    if url is None:
+        url = _build_chart_url(_dumps(config))
+        _cache_put(_URL_CACHE, key, url, URL_CACHE_SIZE)
+    return url
+
+def _json_body(
+    encoded_config: bytes, params: Optional[Dict[str, Any]] = None
+) -> Tuple[bytes, Dict[str, str]]:
+    """Build a chart request body and headers, gzip-compressing large bodies.
+    
+    The already-serialized config is spliced in as the "chart" field rather than
+    being encoded again.
+    """
+    body = b'{"chart":' + encoded_config
+    if params:
+        body += b"," + _dumps(params)[1:-1]
+    body += b"}"
+    headers = {"content-type": "application/json"}
+    if len(body) > GZIP_MIN_SIZE:
+        body = gzip.compress(body, compresslevel=6)
+        headers["content-encoding"] = "gzip"
+    return body, headers
+
+async def _create_short_url(encoded_config: bytes) -> str:
+    """Store the chart configuration on QuickChart and return its short URL."""
+    body, headers = _json_body(encoded_config)
+    client = _get_client()
+    async with _CHART_SEM:
+        response = await client.post(
+            f"{QUICKCHART_BASE_URL}/create", content=body, headers=headers
+        )
+    if response.status_code != 200:
+        raise ValueError(f"Failed to create short chart URL: HTTP {response.status_code}")
+    
+    result = response.json()
+    if not result.get("success") or not result.get("url"):
+        raise ValueError("Failed to create short chart URL: unexpected response from QuickChart")
+    return result["url"]
+
+async def _shareable_chart_url(config: Dict[str, Any]) -> str:
+    """Return a chart URL, replacing URLs over MAX_URL_LENGTH with a QuickChart short URL."""
+    key = _config_key(config)
+    url = _cache_get(_URL_CACHE, key)
+    if url is None:
+        encoded_config = _dumps(config)
+        url = _build_chart_url(encoded_config)
+        if len(url) > MAX_URL_LENGTH:
+            try:
+                url = await _create_short_url(encoded_config)
+            except (httpx.HTTPError, ValueError):
+                # Shortening is best-effort: return the long URL uncached so a later call retries
+                return url
+        _cache_put(_URL_CACHE, key, url, URL_CACHE_SIZE)
+    return url
+
+def _check_dir(directory: Path) -> Tuple[bool, bool]:
+    """Return whether a directory exists and whether it is writable."""
+    return directory.exists(), os.access(directory, os.W_OK)
+
+@asynccontextmanager
+async def _open_atomic(output_path: str) -> AsyncIterator[BinaryIO]:
+    """Open a temporary file next to output_path and move it into place on success.
+    
+    If the block fails or is cancelled, the partial file is removed and any existing
+    file at output_path is left untouched.
+    """
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+    # The open is shielded so that, if we are cancelled while it runs in its worker
+    # thread, the file it creates can still be closed and removed below
+    opening = asyncio.ensure_future(asyncio.to_thread(open, tmp_path, "wb"))
+    f = None
+    try:
+        f = await asyncio.shield(opening)
+        yield f
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, tmp_path, output_path)
+    except BaseException:
+        if f is None:
+            with suppress(Exception):
+                f = await opening
+        if f is not None:
+            f.close()
+        with suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+async def _download_chart(encoded_config: bytes, output_path: str) -> Optional[bytes]:
+    """Render the chart by POSTing its configuration and stream the image to disk.
+    
+    Returns the image bytes if they are small enough to cache, otherwise None.
+    """
+    body, headers = _json_body(encoded_config)
+    client = _get_client()
+    async with _CHART_SEM:
+        async with client.stream(
+            "POST", QUICKCHART_BASE_URL, content=body, headers=headers
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"Failed to fetch chart: HTTP {response.status_code}")
+            
+            # Chunks are kept for the PNG cache only while the image still fits in it
+            chunks: Optional[List[bytes]] = []
+            size = 0
+            async with _open_atomic(output_path) as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+                    if chunks is not None:
+                        size += len(chunk)
+                        if size > PNG_CACHE_MAX_BYTES:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+        
+    return b"".join(chunks) if chunks is not None else None
 
 @mcp.tool()
 async def generate_chart(
@@ -106,42 +334,39 @@ async def generate_chart(
     if not isinstance(config, dict):
         raise ValueError("Config must be a dictionary")
     
-    # Generate URL
-    url = await generate_chart_url(config)
-    
-    # If not downloading, return the URL
+    # If not downloading, return a shareable URL
     if not download:
-        return url
+        return await _shareable_chart_url(config)
     
     # Generate default output_path if not provided
     if not output_path:
-        # Get script directory
-        script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-        
         # Generate a filename based on timestamp
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
         chart_type = config.get("type", "chart")
-        output_path = str(script_dir / f"{chart_type}_{timestamp}.png")
+        output_path = str(_SCRIPT_DIR / f"{chart_type}_{timestamp}.png")
         
         print(f"No output path provided, using: {output_path}")
     
     # Check if the output directory exists and is writable
     output_dir = Path(output_path).parent
+    exists, writable = await asyncio.to_thread(_check_dir, output_dir)
     
-    if not output_dir.exists():
+    if not exists:
         raise ValueError(f"Output directory does not exist: {output_dir}")
     
-    if not os.access(output_dir, os.W_OK):
+    if not writable:
         raise ValueError(f"Output directory is not writable: {output_dir}")
     
-    # Download and save the image
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        if response.status_code != 200:
-            raise Exception(f"Failed to fetch chart: HTTP {response.status_code}")
-        
-        with open(output_path, "wb") as f:
-            f.write(response.content)
+    # Reuse a previously rendered image for an identical config, otherwise render it
+    key = _config_key(config)
+    image = _cache_get(_PNG_CACHE, key)
+    if image is not None:
+        async with _open_atomic(output_path) as f:
+            await asyncio.to_thread(f.write, image)
+    else:
+        image = await _download_chart(_dumps(config), output_path)
+        if image is not None:
+            _png_cache_put(key, image)
     
     return output_path
 
@@ -153,12 +378,16 @@ async def main():
     # Simple transport selection based on environment variable
     transport = os.getenv("TRANSPORT", "stdio")
     
-    if transport == 'sse':      
-        # Run the MCP server with SSE transport
-        await mcp.run_sse_async()
-    else:
-        # Run the MCP server with stdio transport
-        await mcp.run_stdio_async()
+    try:
+        if transport == 'sse':      
+            # Run the MCP server with SSE transport
+            await mcp.run_sse_async()
+        else:
+            # Run the MCP server with stdio transport
+            await mcp.run_stdio_async()
+    finally:
+        # Close the shared HTTP client once the server stops, not per session
+        await _close_client()
         
 if __name__ == "__main__":
     # Run the server
@@ -1,21 +1,112 @@
 #!/usr/bin/env python3
-import os
+import asyncio
+import gzip
+import hashlib
 import json
-from datetime import datetime
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
-from typing import Dict, List, Union, Any, Optional, Literal
+from typing import AsyncIterator, BinaryIO, Dict, List, Union, Any, Optional, Literal, Tuple
+from urllib.parse import urlencode
 
 import httpx
+import numpy as np
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, field_validator
+from pydantic import (
+    BaseModel, Field, PrivateAttr, TypeAdapter, ValidationError, field_validator, model_validator
+)
+from pydantic_core import InitErrorDetails
 from mcp.server.fastmcp import FastMCP
-from quickchart import QuickChart
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder
+    orjson = None
+
+
+def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serialize to compact JSON bytes, using orjson when it is available.
+    
+    orjson rejects integers beyond 64 bits, so those configs are re-encoded with the
+    stdlib encoder. orjson writes NaN and Infinity as null, which Chart.js treats as
+    a missing point, just like NaN. Values neither encoder can handle raise ValueError.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+        except orjson.JSONEncodeError:
+            pass
+    try:
+        return json.dumps(
+            obj, separators=(",", ":"), ensure_ascii=False, sort_keys=sort_keys
+        ).encode()
+    except TypeError as e:
+        raise ValueError(f"Chart configuration is not JSON serializable: {e}") from e
 
 load_dotenv()
 
 # Get base URL from environment variable or use default
 QUICKCHART_BASE_URL = os.environ.get('QUICKCHART_BASE_URL', 'https://quickchart.io/chart')
 
+# Directory of this script, used as the default location for downloaded charts
+_SCRIPT_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+
+# Rendering parameters shared by chart URLs and downloads
+CHART_WIDTH = 600
+CHART_HEIGHT = 300
+CHART_DEVICE_PIXEL_RATIO = 2.0
+
+# Characters not allowed in generated chart filenames
+_UNSAFE_FILENAME = re.compile(r"[^\w \-]")
+
+# Chunk size used when streaming chart images to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# URLs longer than this are replaced by a QuickChart short URL
+MAX_URL_LENGTH = 4096
+
+# Request bodies larger than this are gzip-compressed
+GZIP_MIN_SIZE = 1024
+
+# Caches for repeated requests with identical chart configurations
+URL_CACHE_SIZE = 256
+PNG_CACHE_SIZE = 32
+PNG_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_URL_CACHE: "OrderedDict[bytes, str]" = OrderedDict()
+_PNG_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_png_cache_bytes = 0
+
+# Upper bound on concurrent render requests sent to QuickChart
+MAX_CONCURRENT_REQUESTS = 8
+
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+_CHART_SEM = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+            http2=True,
+        )
+    return _HTTP_CLIENT
+
+
+async def _close_client() -> None:
+    """Close the shared HTTP client, if one was created."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+
 # Define the QuickChart MCP server
 mcp = FastMCP("QuickChart")
 
@@ -31,6 +122,49 @@ ScatterPoint = List[Union[float, int]]  # [x, y] format
 BubblePoint = List[Union[float, int]]   # [x, y, r] format
 
 
+def _classify_data(data: List[Any]) -> Tuple[str, int]:
+    """Classify dataset values by shape.
+    
+    Returns a (kind, point_size) tuple: ("scalar", 1), ("scatter", 2) or ("bubble", 3).
+    Point lists mixing [x, y] and [x, y, r] are reported as ("bubble", 3), and lists
+    mixing plain numbers with points as ("mixed", 0).
+    """
+    # Fast path: homogeneous numeric data converts to an array in a single C pass
+    try:
+        arr = np.asarray(data, dtype=float)
+    except (TypeError, ValueError, OverflowError):
+        arr = None
+    if arr is not None:
+        if arr.ndim == 1:
+            return "scalar", 1
+        if arr.ndim == 2 and arr.shape[1] == 2:
+            return "scatter", 2
+        if arr.ndim == 2 and arr.shape[1] == 3:
+            return "bubble", 3
+        raise ValueError("Data points for scatter/bubble charts must be [x,y] or [x,y,r] format")
+    
+    # Mixed or ragged data: check that all items are either numbers or lists of numbers
+    has_numbers = False
+    max_point_size = 0
+    for item in data:
+        if isinstance(item, list):
+            if not all(isinstance(x, (int, float)) for x in item):
+                raise ValueError("For scatter/bubble charts, data points must be lists of numbers")
+            if not (2 <= len(item) <= 3):
+                raise ValueError("Data points for scatter/bubble charts must be [x,y] or [x,y,r] format")
+            max_point_size = max(max_point_size, len(item))
+        elif isinstance(item, (int, float)):
+            has_numbers = True
+        else:
+            raise ValueError("Data must be a list of numbers or a list of coordinate points")
+    
+    if not max_point_size:
+        return "scalar", 1
+    if has_numbers:
+        return "mixed", 0
+    return ("scatter", 2) if max_point_size == 2 else ("bubble", 3)
+
+
 class Dataset(BaseModel):
     """Data model for chart datasets"""
     label: str = ""
@@ -41,23 +175,22 @@ class Dataset(BaseModel):
 
     model_config = {"extra": "allow"}  # Allow additional fields
     
-    @field_validator('data')
-    def validate_data_format(cls, v):
-        """Validate that data has the correct format"""
-        if not v:
-            raise ValueError("Data cannot be empty")
-            
-        # Check that all items are either numbers or lists of numbers
-        for item in v:
-            if isinstance(item, list):
-                if not all(isinstance(x, (int, float)) for x in item):
-                    raise ValueError("For scatter/bubble charts, data points must be lists of numbers")
-                if not (2 <= len(item) <= 3):
-                    raise ValueError("Data points for scatter/bubble charts must be [x,y] or [x,y,r] format")
-            elif not isinstance(item, (int, float)):
-                raise ValueError("Data must be a list of numbers or a list of coordinate points")
-                
-        return v
+    _data_shape: Optional[Tuple[str, int]] = PrivateAttr(default=None)
+    
+    @model_validator(mode='after')
+    def validate_data_format(self):
+        """Validate that data has the correct format and record its shape"""
+        try:
+            if not self.data:
+                raise ValueError("Data cannot be empty")
+            self._data_shape = _classify_data(self.data)
+        except ValueError as e:
+            # Report the error against the 'data' field rather than the whole dataset
+            raise ValidationError.from_exception_data(
+                type(self).__name__,
+                [InitErrorDetails(type="value_error", loc=("data",), input=self.data, ctx={"error": e})],
+            ) from e
+        return self
 
 
 class ChartData(BaseModel):
@@ -95,27 +228,24 @@ class ChartConfig(BaseModel):
                 raise ValueError(f"{chart_type} requires a single numeric value")
                 
         elif chart_type in ["scatter", "bubble"]:
+            point_format = "[x, y]" if chart_type == "scatter" else "[x, y, r]"
+            min_items = 2
+            max_items = 3 if chart_type == "bubble" else 2
+            
             for dataset in v.datasets:
                 if not dataset.data:
                     raise ValueError(f"{chart_type} requires data points")
                 
-                for item in dataset.data:
-                    if not isinstance(item, list):
-                        point_format = "[x, y]" if chart_type == "scatter" else "[x, y, r]"
-                        raise ValueError(f"{chart_type} requires data points in {point_format} format")
-                    
-                    min_items = 2
-                    max_items = 3 if chart_type == "bubble" else 2
-                    if not (min_items <= len(item) <= max_items):
-                        point_format = "[x, y]" if chart_type == "scatter" else "[x, y, r]"
-                        raise ValueError(f"{chart_type} requires data points in {point_format} format")
+                _, point_size = dataset._data_shape or _classify_data(dataset.data)
+                if not (min_items <= point_size <= max_items):
+                    raise ValueError(f"{chart_type} requires data points in {point_format} format")
         
         # For standard chart types, data should be numbers
         elif chart_type in ["bar", "line", "pie", "doughnut", "radar", "polarArea"]:
             for dataset in v.datasets:
-                for item in dataset.data:
-                    if isinstance(item, list):
-                        raise ValueError(f"{chart_type} requires data to be a list of numbers, not coordinate points")
+                kind, _ = dataset._data_shape or _classify_data(dataset.data)
+                if kind != "scalar":
+                    raise ValueError(f"{chart_type} requires data to be a list of numbers, not coordinate points")
         
         return v
 
@@ -129,14 +259,197 @@ class ChartInput(BaseModel):
     options: Optional[Dict[str, Any]] = Field(default_factory=dict)
 
 
+# Reusable validator for chart inputs passed in as raw dictionaries
+_CHART_INPUT_ADAPTER = TypeAdapter(ChartInput)
+
+
+def _config_key(config: Dict[str, Any]) -> bytes:
+    """Return a stable hash of a chart configuration for cache lookups.
+    
+    Keys are sorted only for hashing. Requests keep the original key order, since
+    Chart.js draws object-form data and scales in insertion order.
+    """
+    return hashlib.blake2b(_dumps(config, sort_keys=True), digest_size=16).digest()
+
+
+def _cache_get(cache: OrderedDict, key: bytes) -> Any:
+    """Look up a cache entry, marking it as most recently used."""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache: OrderedDict, key: bytes, value: Any, max_entries: int) -> None:
+    """Store a cache entry, evicting the least recently used entries over the limit."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+
+
+def _png_cache_put(key: bytes, image: bytes) -> None:
+    """Store a rendered PNG, evicting the least recently used images over the count and byte limits."""
+    global _png_cache_bytes
+    if len(image) > PNG_CACHE_MAX_BYTES:
+        return
+    old = _PNG_CACHE.pop(key, None)
+    if old is not None:
+        _png_cache_bytes -= len(old)
+    _PNG_CACHE[key] = image
+    _png_cache_bytes += len(image)
+    while len(_PNG_CACHE) > PNG_CACHE_SIZE or _png_cache_bytes > PNG_CACHE_MAX_BYTES:
+        _, evicted = _PNG_CACHE.popitem(last=False)
+        _png_cache_bytes -= len(evicted)
+
+
+def _build_chart_url(encoded_config: bytes) -> str:
+    """Build a QuickChart URL from a serialized chart configuration."""
+    params = {
+        "w": CHART_WIDTH,
+        "h": CHART_HEIGHT,
+        "devicePixelRatio": CHART_DEVICE_PIXEL_RATIO,
+        "c": encoded_config.decode(),
+    }
+    return f"{QUICKCHART_BASE_URL}?{urlencode(params)}"
+
+
 def generate_chart_url(config: Dict[str, Any]) -> str:
     """Generate a QuickChart URL from a chart configuration."""
-    qc = QuickChart()
-    qc.width = 600
-    qc.height = 300
-    qc.device_pixel_ratio = 2.0
-    qc.config = json.dumps(config)
-    return qc.get_url()
+    key = _config_key(config)
+    url = _cache_get(_URL_CACHE, key)
+    if url is None:
+        url = _build_chart_url(_dumps(config))
+        _cache_put(_URL_CACHE, key, url, URL_CACHE_SIZE)
+    return url
+
+
+def _json_body(
+    encoded_config: bytes, params: Optional[Dict[str, Any]] = None
+) -> Tuple[bytes, Dict[str, str]]:
+    """Build a chart request body and headers, gzip-compressing large bodies.
+    
+    The already-serialized config is spliced in as the "chart" field rather than
+    being encoded again.
+    """
+    body = b'{"chart":' + encoded_config
+    if params:
+        body += b"," + _dumps(params)[1:-1]
+    body += b"}"
+    headers = {"content-type": "application/json"}
+    if len(body) > GZIP_MIN_SIZE:
+        body = gzip.compress(body, compresslevel=6)
+        headers["content-encoding"] = "gzip"
+    return body, headers
+
+
+async def _create_short_url(encoded_config: bytes) -> str:
+    """Store the chart configuration on QuickChart and return its short URL."""
+    params = {
+        "width": CHART_WIDTH,
+        "height": CHART_HEIGHT,
+        "devicePixelRatio": CHART_DEVICE_PIXEL_RATIO,
+    }
+    body, headers = _json_body(encoded_config, params)
+    client = _get_client()
+    async with _CHART_SEM:
+        response = await client.post(
+            f"{QUICKCHART_BASE_URL}/create", content=body, headers=headers
+        )
+    if response.status_code != 200:
+        raise ValueError(f"Failed to create short chart URL: HTTP {response.status_code}")
+    
+    result = response.json()
+    if not result.get("success") or not result.get("url"):
+        raise ValueError("Failed to create short chart URL: unexpected response from QuickChart")
+    return result["url"]
+
+
+async def _shareable_chart_url(config: Dict[str, Any]) -> str:
+    """Return a chart URL, replacing URLs over MAX_URL_LENGTH with a QuickChart short URL."""
+    key = _config_key(config)
+    url = _cache_get(_URL_CACHE, key)
+    if url is None:
+        encoded_config = _dumps(config)
+        url = _build_chart_url(encoded_config)
+        if len(url) > MAX_URL_LENGTH:
+            try:
+                url = await _create_short_url(encoded_config)
+            except (httpx.HTTPError, ValueError):
+                # Shortening is best-effort: return the long URL uncached so a later call retries
+                return url
+        _cache_put(_URL_CACHE, key, url, URL_CACHE_SIZE)
+    return url
+
+
+def _check_dir(directory: Path) -> Tuple[bool, bool]:
+    """Return whether a directory exists and whether it is writable."""
+    return directory.exists(), os.access(directory, os.W_OK)
+
+
+@asynccontextmanager
+async def _open_atomic(output_path: str) -> AsyncIterator[BinaryIO]:
+    """Open a temporary file next to output_path and move it into place on success.
+    
+    If the block fails or is cancelled, the partial file is removed and any existing
+    file at output_path is left untouched.
+    """
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+    # The open is shielded so that, if we are cancelled while it runs in its worker
+    # thread, the file it creates can still be closed and removed below
+    opening = asyncio.ensure_future(asyncio.to_thread(open, tmp_path, "wb"))
+    f = None
+    try:
+        f = await asyncio.shield(opening)
+        yield f
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, tmp_path, output_path)
+    except BaseException:
+        if f is None:
+            with suppress(Exception):
+                f = await opening
+        if f is not None:
+            f.close()
+        with suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+
+async def _download_chart(encoded_config: bytes, output_path: str) -> Optional[bytes]:
+    """Render a chart by POSTing its configuration and stream the image to disk.
+    
+    Returns the image bytes if they are small enough to cache, otherwise None.
+    """
+    params = {
+        "width": CHART_WIDTH,
+        "height": CHART_HEIGHT,
+        "devicePixelRatio": CHART_DEVICE_PIXEL_RATIO,
+        "format": "png",
+    }
+    body, headers = _json_body(encoded_config, params)
+    client = _get_client()
+    async with _CHART_SEM:
+        async with client.stream(
+            "POST", QUICKCHART_BASE_URL, content=body, headers=headers
+        ) as response:
+            if response.status_code != 200:
+                raise ValueError(f"Failed to fetch chart: HTTP {response.status_code}")
+            
+            # Chunks are kept for the PNG cache only while the image still fits in it
+            chunks: Optional[List[bytes]] = []
+            size = 0
+            async with _open_atomic(output_path) as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+                    if chunks is not None:
+                        size += len(chunk)
+                        if size > PNG_CACHE_MAX_BYTES:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+        
+    return b"".join(chunks) if chunks is not None else None
 
 
 def create_chart_config(chart_input: ChartInput) -> Dict[str, Any]:
@@ -151,8 +464,15 @@ def create_chart_config(chart_input: ChartInput) -> Dict[str, Any]:
     # Create datasets with additionalConfig fields expanded
     processed_datasets = []
     for dataset in chart_input.datasets:
-        # Convert dataset to dict and remove additionalConfig
-        dataset_dict = dataset.model_dump(exclude_none=True)
+        # Read fields directly rather than serializing the model via model_dump
+        dataset_dict = {
+            name: value
+            for name in Dataset.model_fields
+            if (value := getattr(dataset, name)) is not None
+        }
+        dataset_dict.update(
+            (name, value) for name, value in (dataset.model_extra or {}).items() if value is not None
+        )
         additional_config = dataset_dict.pop('additionalConfig', {})
         
         # Merge additional config with dataset dict
@@ -204,61 +524,69 @@ async def generate_chart(
         The URL of the generated chart if download=False, otherwise the path where the chart was saved
     """
     try:
+        # Validate raw dictionaries (e.g. direct calls) into the model
+        if isinstance(chart_input, dict):
+            chart_input = _CHART_INPUT_ADAPTER.validate_python(chart_input)
+        
         # Generate chart config directly from the model
         config = create_chart_config(chart_input)
         
-        # Generate URL from config
-        url = generate_chart_url(config)
-        
-        # If not downloading, return the URL
+        # If not downloading, return a shareable URL
         if not download:
-            return url
+            return await _shareable_chart_url(config)
         
         # Generate default output_path if not provided
         if not output_path:
-            # Get script directory
-            script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-            
             # Generate a filename based on timestamp
-            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            timestamp = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
             chart_type = chart_input.type
             
             # Add title to filename if available
             filename_parts = [chart_type]
             if chart_input.title:
                 # Make the title safe for filesystem use
-                safe_title = "".join(c if c.isalnum() or c in [' ', '-', '_'] else '_' for c in chart_input.title)
-                safe_title = safe_title.strip().replace(' ', '_')
+                safe_title = _UNSAFE_FILENAME.sub('_', chart_input.title).strip().replace(' ', '_')
                 filename_parts.append(safe_title)
             
             filename_parts.append(timestamp)
-            output_path = str(script_dir / f"{'_'.join(filename_parts)}.png")
+            output_path = str(_SCRIPT_DIR / f"{'_'.join(filename_parts)}.png")
             
             print(f"No output path provided, using: {output_path}")
         
         # Check if the output directory exists and is writable
         output_dir = Path(output_path).parent
+        exists, writable = await asyncio.to_thread(_check_dir, output_dir)
         
-        if not output_dir.exists():
+        if not exists:
             raise ValueError(f"Output directory does not exist: {output_dir}")
         
-        if not os.access(output_dir, os.W_OK):
+        if not writable:
             raise ValueError(f"Output directory is not writable: {output_dir}")
         
-        # Download and save the image
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            if response.status_code != 200:
-                raise Exception(f"Failed to fetch chart: HTTP {response.status_code}")
-            
-            with open(output_path, "wb") as f:
-                f.write(response.content)
+        # Reuse a previously rendered image for an identical config, otherwise render it
+        key = _config_key(config)
+        image = _cache_get(_PNG_CACHE, key)
+        if image is not None:
+            async with _open_atomic(output_path) as f:
+                await asyncio.to_thread(f.write, image)
+        else:
+            image = await _download_chart(_dumps(config), output_path)
+            if image is not None:
+                _png_cache_put(key, image)
         
         return output_path
         
-    except Exception as e:
+    except (httpx.HTTPError, ValueError, OSError) as e:
         raise ValueError(f"Failed to generate chart: {str(e)}")
 
 
+async def main():
+    """Run the MCP server over stdio and close the shared HTTP client on exit."""
+    try:
+        await mcp.run_stdio_async()
+    finally:
+        await _close_client()
+
+
 if __name__ == "__main__":
-    mcp.run() 
\ No newline at end of file
+    asyncio.run(main()) 
\ No newline at end of file